@@ -1,16 +1,31 @@
 from dataclasses import dataclass
 import inspect
+import contextlib
 import math
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 import tiktoken
 import sys
 import time
 import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from hellaswag import render_example, iterate_examples
 
+# the model is compiled whenever it runs on the GPU (see torch.compile below)
+use_compile = torch.cuda.is_available()
+# in the compiled model inductor already fuses nn.LayerNorm with the residual adds, while apex's kernel is opaque
+# to dynamo and would break the graph at every LayerNorm. So apex's fused CUDA LayerNorm (one read and one write
+# of the activation) is only used when the model runs eagerly
+LayerNorm = nn.LayerNorm
+if not use_compile:
+    try:
+        from apex.normalization import FusedLayerNorm as LayerNorm
+    except ImportError:
+        pass
+
 #--------------------------------------------------------------------------------------
 
 class CasualSelfAttention(nn.Module):
@@ -25,20 +40,26 @@ class CasualSelfAttention(nn.Module):
         #regularization
         self.n_head = config.n_head
         self.n_embd = config.n_embd
-        # not really a 'bias', but more of a mask, but following the OPENAI/HF naming though
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
-                             .view(1, 1, config.block_size, config.block_size))
+        # no causal mask buffer ('bias' in the OPENAI/HF naming) is needed: scaled_dot_product_attention
+        # with is_causal=True builds the mask internally
         
-    def forward(self, x):
+    def forward(self, x, past_kv=None, use_cache=False):
         B,T,C = x.size() # batch_size, sequnece length, embedding dimensionality (n_embd)
         # calculate query, key and values for all heads in batch and move head forward to be the batch dim
         # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
         # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the Transformer
         qkv = self.c_attn(x)
-        q,k,v = qkv.split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C//self.n_head).transpose(1, 2)# (B, nh, T, hs)
-        q = q.view(B, T, self.n_head, C//self.n_head).transpose(1, 2)# (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C//self.n_head).transpose(1, 2)# (B, nh, T, hs)
+        # split and move the heads forward in a single reshape: q, k and v are all views into qkv
+        qkv = qkv.view(B, T, 3, self.n_head, C//self.n_head).permute(2, 0, 3, 1, 4)# (3, B, nh, T, hs)
+        q,k,v = qkv[0], qkv[1], qkv[2]# each (B, nh, T, hs)
+        # KV cache for generation: past_kv holds the keys and values of all the previous positions,
+        # so only the new token has to be projected and the cached keys/values are appended to
+        if past_kv is not None:
+            assert T == 1, "with a KV cache only one new token can be fed at a time"
+            k = torch.cat((past_kv[0], k), dim=2)# (B, nh, T_past + 1, hs)
+            v = torch.cat((past_kv[1], v), dim=2)
+        # the single new query may attend to every cached position, so no causal mask is needed then
+        is_causal = past_kv is None
 
         # attention (materializes the large (T,T) matrix for all the queries and keys)
         # att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
@@ -47,10 +68,13 @@ class CasualSelfAttention(nn.Module):
         # y = att @ v # (B, nh, T, T) @ (B, nh, T, hs) -> (B, nh, T, hs) weighted sum of values
 
         # in order to speed up the process in GPU we use flash attention for the above caluculations
-        y = F.scaled_dot_product_attention(q,k,v,is_causal=True)# this is the flash attention function
-        y = y.transpose(1, 2).contiguous().view(B, T, C)# re-assemble all head outputs side by side
+        # on CUDA the math backend is disabled at startup, so this is FlashAttention-2 or the memory-efficient kernel
+        y = F.scaled_dot_product_attention(q,k,v,is_causal=is_causal)# this is the flash attention function
+        y = y.transpose(1, 2).reshape(B, T, C)# re-assemble all head outputs side by side, only copies if the strides require it
         #output projection
         y = self.c_proj(y)
+        if use_cache:
+            return y, (k, v)
         return y
     
 # This is the GELU activation function with a tanh approximation
@@ -84,12 +108,17 @@ class Block(nn.Module):
 
     def __init__(self, config) -> None:
         super().__init__()
-        self.ln_1 = nn.LayerNorm(config.n_embd)
+        self.ln_1 = LayerNorm(config.n_embd)
         self.attn = CasualSelfAttention(config)# this is an aggregation function where tokens talk to each other or exchange information
-        self.ln_2 = nn.LayerNorm(config.n_embd)
+        self.ln_2 = LayerNorm(config.n_embd)
         self.mlp = MLP(config)# this is a feedforward neural network: happens to each token independently
 
-    def forward(self, x):
+    def forward(self, x, past_kv=None, use_cache=False):
+        if use_cache:
+            attn_out, present_kv = self.attn(self.ln_1(x), past_kv=past_kv, use_cache=True)
+            x = x + attn_out# add skip connection
+            x = x + self.mlp(self.ln_2(x))
+            return x, present_kv
         x = x + self.attn(self.ln_1(x))# add skip connection
         x = x + self.mlp(self.ln_2(x))# 
         return x
@@ -111,8 +140,8 @@ class GPT(nn.Module):
         self.transformer = nn.ModuleDict(dict(
             wte = nn.Embedding(config.vocab_size, config.n_embd),# wte: token embeddings
             wpe = nn.Embedding(config.block_size, config.n_embd),#wpe = position encodings
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),# h: transformer blocks
-            ln_f = nn.LayerNorm(config.n_embd),#ln_f: final layer normalization
+            h = nn.Sequential(*[Block(config) for _ in range(config.n_layer)]),# h: transformer blocks, Sequential so torch.compile traces them as one graph
+            ln_f = LayerNorm(config.n_embd),#ln_f: final layer normalization
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
 
@@ -122,44 +151,106 @@ class GPT(nn.Module):
         # We will implement this by sharing the weights of the embedding layer and the final linear layer
         self.transformer.wte.weight = self.lm_head.weight
 
+        # activation checkpointing: during training only the input of each Block is kept for backward,
+        # the activations inside the Block are recomputed. This trades some extra compute for a lot of memory.
+        # Off by default: at B=8 the activations fit, so the recompute would only cost tokens/sec. Turn it on
+        # together with a larger B (fewer grad accumulation steps) or for larger models that run out of memory
+        self.use_ckpt = False
+        # number of (B*T) rows the classifier + loss is computed for at a time when use_ckpt is on, see _chunked_loss
+        self.loss_chunk_size = 1024
+
         # weigth initialization
-        self.apply(self._init_weights)# apply the _init_weights function to all the parameters of the model
-
-    # This function initializes the weights of the model
-    def _init_weights(self, module):
-        if isinstance(module, nn.Linear):
-            std = 0.02
-            if hasattr(module, 'NANOGPT_SCALE_INIT'):
-                std *= (2*self.config.n_layer)**-0.5# the scale of the initialization depends on the number of residual layers
-                # The number of residual layers here is 2*self.config.n_layer because there are two residual layers in each block
-            torch.nn.init.normal_(module.weight, mean=0.0, std=std)
-            if module.bias is not None:# if the module has a bias then initialize it to zero
-                torch.nn.init.zeros_(module.bias)
-        elif isinstance(module, nn.Embedding):
-            torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
-
-    def forward(self, idx, targets=None):
+        self._init_weights()# initialize all the parameters of the model
+
+    # This function initializes the weights of the model. The weights are grouped by their std and filled in place,
+    # all the biases are zeroed with a single foreach kernel (there is no foreach version of normal_)
+    @torch.no_grad()
+    def _init_weights(self):
+        weights_by_std = {}
+        biases = []
+        seen = set()# the tied wte / lm_head weight must only be initialized once
+        for module in self.modules():
+            if isinstance(module, nn.Linear):
+                std = 0.02
+                if hasattr(module, 'NANOGPT_SCALE_INIT'):
+                    std *= (2*self.config.n_layer)**-0.5# the scale of the initialization depends on the number of residual layers
+                    # The number of residual layers here is 2*self.config.n_layer because there are two residual layers in each block
+                if module.bias is not None:# if the module has a bias then initialize it to zero
+                    biases.append(module.bias)
+            elif isinstance(module, nn.Embedding):
+                std = 0.02
+            else:
+                continue
+            if id(module.weight) not in seen:
+                seen.add(id(module.weight))
+                weights_by_std.setdefault(std, []).append(module.weight)
+        for std, weights in weights_by_std.items():
+            for w in weights:
+                w.normal_(mean=0.0, std=std)
+        torch._foreach_zero_(biases)
+
+    def forward(self, idx, targets=None, past_kvs=None, use_cache=False):
         # idx is of shape (B,T) where B is batch size and T is the sequence length
+        # past_kvs is the per-layer list of (k, v) returned by a previous call with use_cache=True,
+        # in that case idx only contains the new tokens and (logits, loss, present_kvs) is returned
         B,T = idx.size()
-        assert T<= self.config.block_size, "Cannot forward sequence of length {T}, block size is {self.config.block_size}"
+        T_past = past_kvs[0][0].size(2) if past_kvs is not None else 0
+        assert T_past + T <= self.config.block_size, "Cannot forward sequence of length {T}, block size is {self.config.block_size}"
         # forward the token and position embeddings
-        pos = torch.arange(T, dtype=torch.long, device=idx.device)# shape (T)
+        pos = torch.arange(T_past, T_past + T, dtype=torch.int32, device=idx.device)# shape (T)
         pos_emb = self.transformer['wpe'](pos)# positional embeddings of shape (T, n_embd)
         tok_emb = self.transformer.wte(idx)# token embeddings of shape (B, T, n_embd)
+        # in the compiled model inductor fuses the two gathers and the add into one kernel
         x = tok_emb + pos_emb
         # forward the blocks of transformer
-        for block in self.transformer.h:
-            x = block(x)
+        present_kvs = None
+        if use_cache:
+            present_kvs = []
+            for i, block in enumerate(self.transformer.h):
+                x, present_kv = block(x, past_kv=past_kvs[i] if past_kvs is not None else None, use_cache=True)
+                present_kvs.append(present_kv)
+        elif self.training and self.use_ckpt:
+            for block in self.transformer.h:
+                x = checkpoint(block, x, use_reentrant=False)# non-reentrant version also works with torch.compile
+        else:
+            x = self.transformer.h(x)
         # forward the final layer norm and the classifier
         x = self.transformer.ln_f(x)
-        logits = self.lm_head(x)# (B,T,vocab_size)
-        # Calculating the loss
-        loss = None
-        if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))# The cross entropy does not take multidimensional inputs
-            # We need to flatten the logits and targets
+        if targets is None:
+            # inference: the full logits are needed by the caller
+            logits = self.lm_head(x)# (B,T,vocab_size)
+            loss = None
+        elif self.training and self.use_ckpt:
+            # memory-bound setups: calculating the loss without materializing the (B,T,vocab_size) logits,
+            # at the cost of a second lm_head matmul in backward. The logits are not returned
+            # The cross entropy does not take multidimensional inputs, so we flatten x and the targets
+            logits = None
+            loss = self._chunked_loss(x.view(-1, x.size(-1)), targets.view(-1))
+        else:
+            logits = self.lm_head(x)# (B,T,vocab_size)
+            # The cross entropy does not take multidimensional inputs, so we flatten the logits and targets
+            # the targets may be int32, but cross entropy needs int64 class indices
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1).long())
+        if use_cache:
+            return logits, loss, present_kvs
         return logits, loss
 
+    def _chunked_loss(self, x, targets):
+        # x is (N, n_embd) and targets is (N,). The logits are computed for loss_chunk_size rows at a time and
+        # each chunk is checkpointed, so only x is kept for backward and the chunk logits are recomputed there
+        N = x.size(0)
+        loss = 0.0
+        for i in range(0, N, self.loss_chunk_size):
+            x_chunk = x[i:i+self.loss_chunk_size]
+            targets_chunk = targets[i:i+self.loss_chunk_size]
+            loss = loss + checkpoint(self._loss_sum, x_chunk, targets_chunk, use_reentrant=False)
+        return loss / N
+
+    def _loss_sum(self, x, targets):
+        logits = F.linear(x, self.lm_head.weight)# (chunk, vocab_size)
+        # the targets may be int32, but cross entropy needs int64 class indices
+        return F.cross_entropy(logits, targets.long(), reduction='sum')
+
     @classmethod
     def from_pretrained(cls, model_type):
         """Loads pretrained GPT-2 model weights from huggingface"""
@@ -230,17 +321,30 @@ class GPT(nn.Module):
         fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
         use_fused = fused_available and 'cuda' in device# it basically fuses all the kernel operations into a single kernel
         # this is faster than the non-fused version
-        print(f"using fused AdamW: {use_fused}")
-        optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused)
+        # if the fused kernel is not available on CUDA, fall back to the multi-tensor (foreach) implementation
+        use_foreach = not use_fused and 'cuda' in device
+        print(f"using fused AdamW: {use_fused}, foreach AdamW: {use_foreach}")
+        optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=use_fused, foreach=use_foreach or None)
         return optimizer
 
 # --------------------------------------------------------------------------------------
 
 def load_tokens(filename):
-    npt = np.load(filename)
-    npt = npt.astype(np.int32) # added after video
-    ptt = torch.tensor(npt, dtype=torch.long)
-    return ptt
+    # memory-map the shard instead of reading it into RAM: only the pages a batch touches are read
+    # from disk, so rolling over to the next shard does not stall on copying the whole file
+    npt = np.load(filename, mmap_mode='r')
+    return npt
+
+def prefetch_tokens(filename):
+    # runs in the background thread: mapping the shard is cheap, the disk reads happen on the first access of
+    # each page. Reading the whole shard once here pulls it into the OS page cache, so the slices in next_batch
+    # do not stall the training thread on page faults after the shard rolls over
+    npt = load_tokens(filename)
+    npt.max()
+    return npt
+
+# a single background thread shared by all the data loaders for prefetching their next shard
+shard_prefetcher = ThreadPoolExecutor(max_workers=1)
 
 
 # We create a Dataloader class to feed the data in batches to the model
@@ -281,21 +385,35 @@ class DataloaderLite:
     def reset(self):
         # state, init at shard zero
         self.current_shard = 0
+        self._next_shard_future = None# a prefetch of the shard after the old position is of no use anymore
         self.tokens = load_tokens(self.shards[self.current_shard])
         self.current_position = self.B * self.T * self.process_rank
 
     def next_batch(self):
         B,T = self.B, self.T
         # get the next batch
-        buf = self.tokens[self.current_position: self.current_position+B*T+1]# We add an additional token so that we can have a target sequence
+        tokens = self.tokens[self.current_position: self.current_position+B*T+1]# We add an additional token so that we can have a target sequence
+        # keep the tokens int32 end-to-end, nn.Embedding accepts int32 indices. The slice is converted straight into
+        # page-locked memory (one host copy), so that the host to device copies can be asynchronous. The pinned
+        # allocator only hands a buffer out again once the async copy reading it has finished
+        buf = torch.empty(len(tokens), dtype=torch.int32, pin_memory=torch.cuda.is_available())
+        np.copyto(buf.numpy(), tokens)
         x = buf[:-1].view(B,T)# (B,T): inputs
         y = buf[1:].view(B,T)# (B,T): targets
         # advance the positions in the tensor
         self.current_position += B*T * self.num_processes
+        # once 90% of the current shard is consumed, start reading the next one in the background
+        if self._next_shard_future is None and self.current_position > 0.9 * len(self.tokens):
+            next_shard = (self.current_shard + 1) % len(self.shards)
+            self._next_shard_future = shard_prefetcher.submit(prefetch_tokens, self.shards[next_shard])
         # if loading the next batch would overrun the tokens, reset the position
         if self.current_position + (B*T*self.num_processes + 1) > len(self.tokens):
             self.current_shard = (self.current_shard + 1) % len(self.shards)
-            self.tokens = load_tokens(self.shards[self.current_shard])
+            if self._next_shard_future is not None:
+                self.tokens = self._next_shard_future.result()# usually already done
+                self._next_shard_future = None
+            else:
+                self.tokens = load_tokens(self.shards[self.current_shard])
             self.current_position = self.B * self.T * self.process_rank
         return x,y
 
@@ -394,15 +512,33 @@ if master_process:
 train_loader = DataloaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split='train')
 val_loader = DataloaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split='val')
 
-# torch.set_float32_matmul_precision("high")# high precision for matrix multiplication: this gives better throughput on the GPU
+torch.set_float32_matmul_precision("high")# high precision for matrix multiplication: this gives better throughput on the GPU
+# use TF32 on the tensor cores for whatever still runs in float32 (outside of autocast), also for the cuDNN paths
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+# attention backends: never let scaled_dot_product_attention silently fall back to the slow math backend on the GPU.
+# FlashAttention-2 covers half precision on sm80+, the memory-efficient kernel covers the older GPUs and the float32
+# HellaSwag eval and KV cache sampling. On CPU / MPS the dispatcher is left alone
+if device.startswith("cuda"):
+    torch.backends.cuda.enable_math_sdp(False)
 
 model = GPT(GPTConfig(vocab_size=50304))# increasing the number of fake tokens, so that the number of tokens is power of 2
 model.eval()
 model.to(device)
-#model = torch.compile(model)# compile the model to TorchScript for better performance
+# the plain model, neither compiled nor wrapped in DDP. Used for the optimizer setup and for the
+# HellaSwag eval and the sampling, whose sequence lengths vary and would keep recompiling the model
+raw_model = model
+# opt-in CUDA graph capture of the training micro step, see below
+use_cuda_graph = False
+if use_compile:
+    # the shapes never change during training, so specialize for them (dynamic=False), autotune the matmul kernels
+    # and fail on graph breaks instead of silently splitting the graph. No inductor CUDA graphs: the grads accumulated
+    # over the micro steps (and the DDP hooks) must not live in a graph pool that the next replay overwrites,
+    # and they would also clash with our own use_cuda_graph capture
+    model = torch.compile(model, mode="max-autotune-no-cudagraphs", fullgraph=True, dynamic=False)
 if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model # if DDP is used, then model is a wrapper around the actual model
+    # the graph is the same every step, static_graph lets DDP reuse its bucket order and skip unused-parameter checks
+    model = DDP(model, device_ids=[ddp_local_rank], static_graph=True)
 
 # Implementing Learning Rate Scheduler
 max_lr = 6e-4# According to GPT3 paper for the GPT3 small model
@@ -427,6 +563,16 @@ def get_lr(it):
 # optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4, betas=(0.9, 0.95), eps=1e-8)# AdamW optimizer
 optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device=device)# This is the optimizer used in the GPT3 paper
 
+# Mixed precision: run the forward pass in bfloat16 when the GPU supports it (Ampere+), otherwise
+# fall back to float16 together with a GradScaler so that small gradients do not underflow
+device_type = "cuda" if device.startswith("cuda") else "cpu"
+use_autocast = device_type == "cuda"
+# native bfloat16 needs compute capability 8.0, is_bf16_supported() would also report the slow emulation on older GPUs
+autocast_dtype = torch.bfloat16 if use_autocast and torch.cuda.get_device_capability() >= (8, 0) else torch.float16
+scaler = torch.amp.GradScaler("cuda", enabled=(use_autocast and autocast_dtype == torch.float16))# no-op for bfloat16
+if master_process:
+    print(f"autocast: {use_autocast}, dtype: {autocast_dtype if use_autocast else torch.float32}")
+
 # create the log directory we eill write checkpoints to and the logging file
 log_dir = "logs"
 os.makedirs(log_dir, exist_ok=True)
@@ -434,6 +580,39 @@ log_file = os.path.join(log_dir, "log.txt")
 with open(log_file, "w") as f:# open for writeing to clear the file
     pass
 
+# the tokenizer and the prompt used for sampling are the same every time, so build them only once
+enc = tiktoken.get_encoding('gpt2')
+prompt_tokens = torch.tensor(enc.encode("Hi, I'm a language model,"), dtype=torch.long)# (8,)
+# one random number generator per rank for the sampling, different seed on every rank
+sample_rng = torch.Generator(device=device)
+
+# CUDA graph for the micro step: every micro step has the same shapes and the same kernels, so the forward +
+# backward can be captured once and replayed, which removes the python dispatch and kernel launch overhead.
+# Only for single GPU runs in bfloat16: the DDP no_sync toggling and the float16 GradScaler are not captured
+if use_cuda_graph:
+    assert device_type == "cuda" and not ddp and not scaler.is_enabled(), "CUDA graphs need a single GPU bfloat16 run"
+    model.train()
+    x,y = train_loader.next_batch()
+    static_x, static_y = x.to(device), y.to(device)# the graph always reads its inputs from these tensors
+    # warmup on a side stream before capturing, as required by torch.cuda.graph
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for _ in range(3):
+            with torch.autocast(device_type=device_type, dtype=autocast_dtype, cache_enabled=False):
+                _, static_loss = model(static_x, static_y)
+            static_loss.backward()
+    torch.cuda.current_stream().wait_stream(side_stream)
+    # the grads have to exist before the capture so that the replayed backward accumulates into them in place
+    optimizer.zero_grad(set_to_none=False)
+    cuda_graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(cuda_graph):
+        with torch.autocast(device_type=device_type, dtype=autocast_dtype, cache_enabled=False):
+            _, static_loss = model(static_x, static_y)
+        static_loss.backward()
+    optimizer.zero_grad(set_to_none=False)
+    train_loader.reset()# start the training from the first batch
+
 
 for step in range(max_steps):
     t0 = time.time()
@@ -447,7 +626,7 @@ for step in range(max_steps):
             val_loss_steps = 20
             for _ in range(val_loss_steps):
                 x,y = val_loader.next_batch()
-                x,y = x.to(device), y.to(device)
+                x,y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
                 logits, loss = model(x,y)
                 loss = loss / val_loss_steps
                 val_loss_accum += loss.detach()
@@ -472,7 +651,7 @@ for step in range(max_steps):
             mask = mask.to(device)
             #get the logits
             with torch.no_grad():
-                logits,loss = model(tokens)
+                logits,loss = raw_model(tokens)
                 pred_norm = get_most_likely_row(tokens, mask, logits)
             num_total += 1
             num_correct_norm += int(pred_norm == label)
@@ -497,18 +676,17 @@ for step in range(max_steps):
         num_return_sequences = 4
         max_length = 32
         # prefix tokens
-        enc = tiktoken.get_encoding('gpt2')
-        tokens = enc.encode("Hi, I'm a language model,")
-        tokens = torch.tensor(tokens,dtype=torch.long)# (8,)
-        tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)# (5,8)
+        tokens = prompt_tokens.unsqueeze(0).repeat(num_return_sequences, 1)# (5,8)
         xgen = tokens.to(device)
         # generate right now x is (B,T) where B is 5 and T is 8
-        sample_rng = torch.Generator(device=device)
-        sample_rng.manual_seed(42+ddp_rank)# set the seed for the random number generator
+        sample_rng.manual_seed(42+ddp_rank)# reset the seed so every sampling round starts from the same state
+        # with the KV cache the prompt is forwarded once, afterwards only the newly sampled token is fed
+        past_kvs = None
+        xnext = xgen
         while xgen.size(1) < max_length:
             # forward the model to get the logits
             with torch.no_grad():
-                logits,loss = model(xgen)# (B,T, vocab_size)
+                logits, _, past_kvs = raw_model(xnext, past_kvs=past_kvs, use_cache=True)# (B,T, vocab_size)
                 # take the logits at the last position
                 logits = logits[:, -1, :]# (B, vocab_size)
                 # get the probabilities
@@ -523,6 +701,7 @@ for step in range(max_steps):
                 xcol = torch.gather(topk_indices, -1, ix)# (B,1)
                 # append to the sequence
                 xgen = torch.cat((xgen, xcol), dim=1)
+                xnext = xcol
         # print yhe generated text
         for i in range(num_return_sequences):
             generated = xgen[i, :max_length].tolist()
@@ -532,29 +711,41 @@ for step in range(max_steps):
 
     # Training loop
     model.train()
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=not use_cuda_graph)# free the grads instead of writing zeros into them (the CUDA graph needs them kept)
     loss_accum = 0.0
     for micro_steps in range(grad_accum_Steps):
         x,y = train_loader.next_batch()
-        x,y = x.to(device), y.to(device)
-        # with torch.autocast(device_type=device, dtype=torch.bfloat16):# use bfloat16 for training as it is faster
-        #     logits, loss = model(x,y)
-        # The above code is not working because the my current GPU is not supporting bfloat16
-        logits, loss = model(x,y)
-        loss = loss / grad_accum_Steps# scale the loss
-        loss_accum += loss.detach()# accumulate the loss for all the gradient accumulation steps
-        if ddp:
-            model.require_backward_grad_sync = (micro_steps == grad_accum_Steps - 1)# sync the gradients across all the GPUs
-        loss.backward()# deposists the gradients in the parameters
+        if use_cuda_graph:
+            # replay the captured forward + backward on the new batch, the grads accumulate across the replays
+            static_x.copy_(x, non_blocking=True)
+            static_y.copy_(y, non_blocking=True)
+            cuda_graph.replay()
+            loss_accum += static_loss.detach()
+            continue
+        x,y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)# async copy, overlaps with the queued compute
+        # only sync the gradients across all the GPUs on the last micro step, no_sync skips the all-reduce otherwise
+        sync_ctx = model.no_sync() if ddp and micro_steps < grad_accum_Steps - 1 else contextlib.nullcontext()
+        with sync_ctx:
+            with torch.autocast(device_type=device_type, dtype=autocast_dtype, enabled=use_autocast):# bfloat16 (or float16) matmuls on the tensor cores
+                logits, loss = model(x,y)
+            # the loss scaling and the backward pass stay outside of autocast so the reductions run in float32
+            # the loss is not divided by grad_accum_Steps here, the accumulated gradients are scaled once after the loop
+            loss_accum += loss.detach()# accumulate the loss for all the gradient accumulation steps
+            scaler.scale(loss).backward()# deposists the gradients in the parameters
+    loss_accum /= grad_accum_Steps# mean loss over the micro steps
     if ddp:
         dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG)# average the loss across all the GPUs
+    scaler.unscale_(optimizer)# the gradients have to be unscaled before clipping (no-op when the scaler is disabled)
+    # turn the summed gradients of the micro steps into their mean with one multi-tensor kernel
+    torch._foreach_mul_([p.grad for p in model.parameters() if p.grad is not None], 1.0 / grad_accum_Steps)
     norm = nn.utils.clip_grad_norm_(model.parameters(), 1.0)# clip the gradients to avoid exploding gradients
     # this is basically performed if suppose we get a bad batch which results in a very high loss which could then lead to a high gradient
     # and this could shock the model and could lead to a bad model
     lr = get_lr(step)
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
-    optimizer.step()# updates the parameters
+    scaler.step(optimizer)# updates the parameters (skips the step if the float16 gradients overflowed)
+    scaler.update()
     torch.cuda.synchronize()# wait for the GPU to finish the current iteration
     t1 = time.time()
     dt = (t1 - t0)*1000 # time difference in milliseconds